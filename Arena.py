@@ -0,0 +1,304 @@
+# Self-play arena for LoRiggio's Liar's Dice
+#
+# Pits decision policies against each other over lots of LiarsDiceGame matches,
+# spread across a process pool. Run it directly: `python Arena.py --help`
+
+
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import random
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from LiarsDice import LiarsDiceGame, LiarsDiceGameMode, ErrorResponse, GAMEMODE_CONVERSION, PlayerRef
+
+
+# A policy looks at the game from one player's seat and either returns the bet it wants to raise to,
+# formatted like LiarsDiceGame.current_bet, or None to call the current bet.
+Policy = Callable[[LiarsDiceGame, PlayerRef], Optional[tuple[int, int]]]
+
+
+# region Helper Functions
+
+def bet_probability(game: LiarsDiceGame, player: PlayerRef, bet: tuple[int, int]) -> float:
+    """Chance that a bet holds, given the player's own cup and nothing else."""
+    dice_count, dice_num = bet
+    needed = dice_count - game.player_states[player.id].count(dice_num)
+    unknown = game.total_dice() - game.player_states[player.id].num_dice
+    if needed <= 0:
+        return 1.0
+    if needed > unknown:
+        return 0.0
+    p = 1 / game.dice_sides
+    return sum(math.comb(unknown, k) * p ** k * (1 - p) ** (unknown - k) for k in range(needed, unknown + 1))
+
+
+def wilson_interval(wins: float, games: int, z: float = 1.96) -> tuple[float, float]:
+    if games == 0:
+        return 0.0, 1.0
+    rate = wins / games
+    denom = 1 + z * z / games
+    center = (rate + z * z / (2 * games)) / denom
+    spread = z * math.sqrt(rate * (1 - rate) / games + z * z / (4 * games * games)) / denom
+    return max(0.0, center - spread), min(1.0, center + spread)
+
+# endregion
+
+
+# region Policies
+
+class RandomPolicy:
+    """Calls with a fixed chance, otherwise picks one of the next few legal raises at random."""
+
+    def __init__(self, call_chance: float = 0.3, spread: int = 6):
+        self.call_chance = call_chance
+        self.spread = spread
+
+    def __call__(self, game: LiarsDiceGame, player: PlayerRef) -> Optional[tuple[int, int]]:
+        if game.current_bet != (0, 0) and random.random() < self.call_chance:
+            return None
+        raises = game.legal_raises(self.spread)
+        return random.choice(raises) if raises else None
+
+
+class ThresholdPolicy:
+    """Calls when the current bet is less likely than `threshold`, otherwise makes the likeliest cheap raise."""
+
+    def __init__(self, threshold: float = 0.5, spread: int = 12):
+        self.threshold = threshold
+        self.spread = spread
+
+    def __call__(self, game: LiarsDiceGame, player: PlayerRef) -> Optional[tuple[int, int]]:
+        if game.current_bet != (0, 0) and bet_probability(game, player, game.current_bet) < self.threshold:
+            return None
+        raises = game.legal_raises(self.spread)
+        if not raises:
+            return None
+        return max(raises, key=lambda bet: bet_probability(game, player, bet))
+
+
+class TablePolicy:
+    """
+    Looks up how likely it is to call in a table keyed by the bet's surplus,
+    i.e. how many dice the bet claims beyond what the player holds plus the expected count among the others.
+    Keys outside the table are clamped to its nearest edge.
+    """
+
+    def __init__(self, table: dict[int, float], spread: int = 12):
+        self.table = table
+        self.spread = spread
+
+    def surplus(self, game: LiarsDiceGame, player: PlayerRef, bet: tuple[int, int]) -> int:
+        dice_count, dice_num = bet
+        unknown = game.total_dice() - game.player_states[player.id].num_dice
+        expected = game.player_states[player.id].count(dice_num) + unknown / game.dice_sides
+        return round(dice_count - expected)
+
+    def __call__(self, game: LiarsDiceGame, player: PlayerRef) -> Optional[tuple[int, int]]:
+        if game.current_bet != (0, 0):
+            key = min(max(self.surplus(game, player, game.current_bet), min(self.table)), max(self.table))
+            if random.random() < self.table.get(key, 0.0):
+                return None
+        raises = game.legal_raises(self.spread)
+        if not raises:
+            return None
+        return min(raises, key=lambda bet: self.surplus(game, player, bet))
+
+
+POLICIES: dict[str, Callable[[], Policy]] = {
+    "random": RandomPolicy,
+    "threshold": ThresholdPolicy,
+    "cautious": lambda: ThresholdPolicy(threshold=0.7),
+    "table": lambda: TablePolicy({-1: 0.0, 0: 0.2, 1: 0.6, 2: 0.9, 3: 1.0}),
+}
+
+TABLE_POLICY_PREFIX = "table:"  # "table:<path>" loads a TablePolicy from a JSON {surplus: call probability} file
+
+
+def load_table(path: str) -> dict[int, float]:
+    with open(path, "r") as fp:
+        table = {int(surplus): float(chance) for surplus, chance in json.load(fp).items()}
+    if not table:
+        raise ValueError(f"Table in '{path}' is empty")
+    return table
+
+
+def make_policy(name: str) -> Policy:
+    if name.startswith(TABLE_POLICY_PREFIX):
+        return TablePolicy(load_table(name[len(TABLE_POLICY_PREFIX):]))
+    return POLICIES[name]()
+
+
+def policy_name(name: str) -> str:
+    """argparse type for policy names, which checks table files up front instead of in every worker."""
+    if name.startswith(TABLE_POLICY_PREFIX):
+        try:
+            load_table(name[len(TABLE_POLICY_PREFIX):])
+        except (OSError, ValueError) as err:
+            raise argparse.ArgumentTypeError(f"Bad policy table: {err}")
+    elif name not in POLICIES:
+        raise argparse.ArgumentTypeError(f"Unknown policy '{name}', "
+                                         f"pick from {', '.join(POLICIES)} or use {TABLE_POLICY_PREFIX}<path>")
+    return name
+
+# endregion
+
+
+# region Match Running
+
+def play_match(policies: list[Policy], gamemode: LiarsDiceGameMode, dice_per_player: int = 5, dice_sides: int = 6,
+               allow_count_reset_on_increment: bool = False, max_rounds: int = 50) -> tuple[list[float], bool]:
+    """
+    Play a single game to completion. Returns each seat's share of the win, and whether the game was cut off.
+    Only INFINITE games are cut off, after `max_rounds` rounds, and scored by fewest losses.
+    The other modes take a die away every round, so they always finish on their own.
+    """
+    players = [PlayerRef(id=seat, mention=f"seat{seat}", display_name=f"seat{seat}") for seat in range(len(policies))]
+    game = LiarsDiceGame(players[0], dice_per_player=dice_per_player, dice_sides=dice_sides, gamemode=gamemode,
+                         allow_count_reset_on_increment=allow_count_reset_on_increment)
+    for player in players[1:]:
+        game.join(player)
+    game.start(players[0])
+
+    while True:
+        while game.in_round:
+            player = game.get_player(game.raiser_idx)
+            bet = policies[player.id](game, player)
+            if bet is None and game.current_bet != (0, 0):
+                game.call_bet(player)
+                continue
+            try:
+                game.raise_bet(player, *(bet or game.legal_raises(1)[0]))
+            except (ErrorResponse, IndexError):
+                # Illegal or impossible raise, so the policy is stuck calling
+                game.call_bet(player)
+        if game.is_game_finished:
+            break
+        if gamemode == LiarsDiceGameMode.INFINITE and game.round_num >= max_rounds:
+            break
+        game.begin_next_round()
+
+    if len(game.live_players) == 1:
+        winners = [game.live_players[0]]
+    else:
+        fewest_losses = min(game.player_states[p.id].loss_count for p in game.live_players)
+        winners = [p for p in game.live_players if game.player_states[p.id].loss_count == fewest_losses]
+    shares = [0.0] * len(players)
+    for p in winners:
+        shares[p.id] = 1 / len(winners)
+    return shares, not game.is_game_finished
+
+
+@dataclass(frozen=True)
+class ArenaTask:
+    policy_names: tuple[str, ...]
+    gamemode: str
+    games: int
+    seed: int
+    dice_per_player: int
+    dice_sides: int
+    allow_count_reset_on_increment: bool
+    max_rounds: int
+
+
+def run_task(task: ArenaTask) -> tuple[ArenaTask, list[float], int]:
+    # Seeds belong to the task rather than the worker, so results don't depend on scheduling
+    random.seed(task.seed)
+    policies = [make_policy(name) for name in task.policy_names]
+    gamemode = GAMEMODE_CONVERSION[task.gamemode]
+    wins = [0.0] * len(policies)
+    truncated = 0
+    for i in range(task.games):
+        # Rotate seats so nobody gets to always bet first
+        offset = i % len(policies)
+        seated = policies[offset:] + policies[:offset]
+        shares, cut_off = play_match(seated, gamemode, task.dice_per_player, task.dice_sides,
+                                     task.allow_count_reset_on_increment, task.max_rounds)
+        for seat, share in enumerate(shares):
+            wins[(seat + offset) % len(policies)] += share
+        truncated += cut_off
+    return task, wins, truncated
+
+
+def task_seed(seed: int, idx: int) -> int:
+    # Hash the pair, so runs with neighbouring base seeds don't end up sharing task seeds
+    return random.Random(f"{seed}:{idx}").getrandbits(64)
+
+
+def build_tasks(policy_names: list[str], gamemodes: list[LiarsDiceGameMode], games: int, chunk_size: int,
+                seed: int, table_size: int, dice_per_player: int, dice_sides: int,
+                allow_count_reset_on_increment: bool, max_rounds: int) -> list[ArenaTask]:
+    tasks = []
+    for matchup in itertools.combinations_with_replacement(policy_names, table_size):
+        if len(set(matchup)) < 2:
+            continue
+        for gamemode in gamemodes:
+            for start in range(0, games, chunk_size):
+                tasks.append(ArenaTask(matchup, gamemode.name, min(chunk_size, games - start),
+                                       task_seed(seed, len(tasks)), dice_per_player, dice_sides,
+                                       allow_count_reset_on_increment, max_rounds))
+    return tasks
+
+
+def run_arena(tasks: list[ArenaTask], out_path: str, processes: Optional[int] = None):
+    """Runs every task over a process pool, appending running totals to `out_path` as JSON lines."""
+    totals: dict[tuple[tuple[str, ...], str], list[float]] = {}
+    played: dict[tuple[tuple[str, ...], str], int] = {}
+    truncated: dict[tuple[tuple[str, ...], str], int] = {}
+    started = time.monotonic()
+
+    with multiprocessing.Pool(processes) as pool, open(out_path, "a") as fp:
+        for task, wins, cut_off in pool.imap_unordered(run_task, tasks):
+            key = task.policy_names, task.gamemode
+            seat_totals = totals.setdefault(key, [0.0] * len(wins))
+            for seat, share in enumerate(wins):
+                seat_totals[seat] += share
+            played[key] = played.get(key, 0) + task.games
+            truncated[key] = truncated.get(key, 0) + cut_off
+
+            results = []
+            for seat, name in enumerate(task.policy_names):
+                low, high = wilson_interval(seat_totals[seat], played[key])
+                results.append({"seat": seat, "policy": name, "wins": seat_totals[seat],
+                                "win_rate": seat_totals[seat] / played[key], "ci_low": low, "ci_high": high})
+            fp.write(json.dumps({"matchup": list(task.policy_names), "gamemode": task.gamemode,
+                                 "games": played[key], "truncated": truncated[key], "elapsed": time.monotonic() - started,
+                                 "results": results}) + "\n")
+            fp.flush()
+
+# endregion
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pit Liar's Dice policies against each other.")
+    parser.add_argument("--policies", nargs="+", default=list(POLICIES), type=policy_name,
+                        help=f"Built in: {', '.join(POLICIES)}. "
+                             f"Use {TABLE_POLICY_PREFIX}<path> for a table-driven policy loaded from a JSON file "
+                             f"mapping bet surplus to call probability.")
+    parser.add_argument("--modes", nargs="+", default=[mode.name for mode in LiarsDiceGameMode],
+                        choices=list(GAMEMODE_CONVERSION))
+    parser.add_argument("--games", type=int, default=10_000, help="Games per matchup per mode.")
+    parser.add_argument("--chunk-size", type=int, default=1_000, help="Games per pool task.")
+    parser.add_argument("--table-size", type=int, default=2, help="Players per game.")
+    parser.add_argument("--dice", type=int, default=5, help="Dice per player.")
+    parser.add_argument("--sides", type=int, default=6)
+    parser.add_argument("--allow-count-reset", action="store_true")
+    parser.add_argument("--max-rounds", type=int, default=50,
+                        help="Rounds before an INFINITE game is cut off and scored by fewest losses.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=None, help="Defaults to the number of cores.")
+    parser.add_argument("--out", default="arena_results.jsonl")
+    args = parser.parse_args()
+
+    tasks = build_tasks(args.policies, [GAMEMODE_CONVERSION[mode] for mode in args.modes], args.games,
+                        args.chunk_size, args.seed, args.table_size, args.dice, args.sides, args.allow_count_reset,
+                        args.max_rounds)
+    run_arena(tasks, args.out, args.processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+# Game worker processes for LoRiggio
+#
+# Keeps Liar's Dice games out of the gateway process: each worker owns the games for its share of channels
+# and runs LiarsDice.GAME_OPS against them, so a heavy call on a big table can't hold up the event loop.
+
+
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+from multiprocessing.connection import Connection
+
+import discord
+
+import LiarsDice
+from LiarsDice import ErrorResponse, GameReply
+
+log = logging.getLogger("loriggio.workers")
+
+
+# region Wire Format
+
+# Embeds go over the pipe as dicts, everything else in a reply pickles as-is
+
+def pack_result(result):
+    if isinstance(result, list):
+        return [GameReply(reply.content, reply.embed.to_dict() if reply.embed else None,
+                          reply.view, reply.private, reply.delete_after)
+                if isinstance(reply, GameReply) else reply
+                for reply in result]
+    return result
+
+
+def unpack_result(result):
+    if isinstance(result, list):
+        for reply in result:
+            if isinstance(reply, GameReply) and reply.embed is not None:
+                reply.embed = discord.Embed.from_dict(reply.embed)
+    return result
+
+# endregion
+
+
+def worker_main(requests: Connection, responses: Connection):
+    """Entry point of a worker process. LiarsDice.ld_games in here only ever holds this worker's channels."""
+    # Ctrl+C, and service managers' SIGTERM, reach the whole process group. Leave that group, so shutdown is
+    # left to the gateway, which tells each worker when to stop. A direct terminate() still gets through
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+    else:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        while True:
+            try:
+                msg = requests.recv()
+            except EOFError:
+                break
+            if msg is None:
+                break
+
+            req_id, op, args, kwargs = msg
+            try:
+                responses.send((req_id, True, pack_result(LiarsDice.GAME_OPS[op](*args, **kwargs))))
+            except ErrorResponse as err:
+                responses.send((req_id, False, (True, str(err))))
+            except Exception as err:
+                responses.send((req_id, False, (False, f"{err.__class__.__name__}: {err}")))
+    finally:
+        # Worker processes skip atexit handlers, so the history has to be finished off here
+        LiarsDice.stop_history()
+
+
+WORKER_LOST_MSG = ("The game worker for this channel crashed, and the game went down with it. "
+                   "Run `/liars new` to start another one.")
+
+
+class GameWorker:
+    """
+    Gateway-side handle on one worker process. Requests are queued for a writer thread, so a worker that's
+    slow to read never blocks the event loop, and a reader thread hands responses back to the loop.
+    """
+
+    def __init__(self, ctx: multiprocessing.context.BaseContext, loop: asyncio.AbstractEventLoop, idx: int):
+        self.loop = loop
+        self.pending: dict[int, asyncio.Future] = {}
+        self.req_ids = itertools.count()
+        self.outbox = queue.SimpleQueue()
+        self.closing = False
+        self.dead = False
+
+        # One pipe each way, so the reader and writer threads never share a connection
+        worker_requests, self.requests = ctx.Pipe(duplex=False)
+        self.responses, worker_responses = ctx.Pipe(duplex=False)
+        self.process = ctx.Process(target=worker_main, args=(worker_requests, worker_responses),
+                                   name=f"loriggio-games-{idx}", daemon=True)
+        self.process.start()
+        worker_requests.close()
+        worker_responses.close()
+
+        self.reader = threading.Thread(target=self.read_responses, name=f"loriggio-games-{idx}-reader", daemon=True)
+        self.reader.start()
+        self.writer = threading.Thread(target=self.write_requests, name=f"loriggio-games-{idx}-writer", daemon=True)
+        self.writer.start()
+
+    def is_alive(self) -> bool:
+        return not self.dead and self.process.is_alive()
+
+    # region Threads
+
+    def read_responses(self):
+        while True:
+            try:
+                req_id, ok, payload = self.responses.recv()
+            except (EOFError, OSError):
+                break
+            self.loop.call_soon_threadsafe(self.resolve, req_id, ok, payload)
+        self.on_stopped()
+
+    def write_requests(self):
+        while True:
+            msg = self.outbox.get()
+            try:
+                self.requests.send(msg)
+            except OSError:
+                self.on_stopped()
+                break
+            except Exception as err:
+                # Most likely an argument that doesn't pickle. Nothing went down the pipe, so only this request failed
+                log.exception("Couldn't send a request to game worker %s", self.process.name)
+                try:
+                    self.loop.call_soon_threadsafe(self.resolve, msg[0], False,
+                                                   (False, f"{err.__class__.__name__}: {err}"))
+                except RuntimeError:
+                    pass  # The loop already closed, so nobody is waiting anymore
+                continue
+            if msg is None:
+                break
+
+    def on_stopped(self):
+        if self.dead:
+            return
+        self.dead = True
+        if not self.closing:
+            log.error("Game worker %s stopped responding", self.process.name)
+        try:
+            self.loop.call_soon_threadsafe(self.fail_pending)
+        except RuntimeError:
+            pass  # The loop already closed, so nobody is waiting anymore
+
+    # endregion
+
+    def resolve(self, req_id: int, ok: bool, payload):
+        future = self.pending.pop(req_id, None)
+        if future is None or future.done():
+            return
+        if ok:
+            future.set_result(unpack_result(payload))
+        else:
+            is_error_response, msg = payload
+            future.set_exception(ErrorResponse(msg) if is_error_response else RuntimeError(msg))
+
+    def fail_pending(self):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ErrorResponse(WORKER_LOST_MSG))
+        self.pending.clear()
+
+    def submit(self, op: str, args: tuple, kwargs: dict) -> asyncio.Future:
+        future = self.loop.create_future()
+        if self.dead:
+            future.set_exception(ErrorResponse(WORKER_LOST_MSG))
+            return future
+        req_id = next(self.req_ids)
+        self.pending[req_id] = future
+        self.outbox.put((req_id, op, args, kwargs))
+        return future
+
+    def close(self):
+        self.closing = True
+        self.outbox.put(None)
+        self.writer.join(timeout=5)
+        self.process.join(timeout=5)
+
+    def kill(self):
+        """Stop the worker without waiting on it, for replacing one that has died or stopped answering."""
+        self.closing = True
+        self.outbox.put(None)
+        self.process.kill()
+
+
+class ProcessGameExecutor:
+    """
+    Runs game operations in a pool of worker processes, each owning the games of the channels that hash to it.
+    Drop-in replacement for LiarsDice.LocalGameExecutor. Has to be created from inside the running event loop.
+    Workers that die are replaced on their next use. Their games are lost, but the settings broadcast to them aren't.
+    """
+
+    def __init__(self, num_workers: int):
+        # Spawn rather than fork: the gateway process already has threads and a running loop by now
+        self.ctx = multiprocessing.get_context("spawn")
+        self.loop = asyncio.get_running_loop()
+        self.workers = [GameWorker(self.ctx, self.loop, idx) for idx in range(num_workers)]
+        self.broadcasts: dict[str, tuple[tuple, dict]] = {}  # Latest arguments of each broadcast op, for respawns
+
+    def worker(self, idx: int) -> GameWorker:
+        worker = self.workers[idx]
+        if not worker.is_alive() and not worker.closing:
+            log.warning("Respawning game worker %s, its games are lost", worker.process.name)
+            # Anything that blocks here holds up every other channel, so reap the old process off the loop
+            worker.kill()
+            self.loop.run_in_executor(None, worker.process.join)
+            worker = self.workers[idx] = GameWorker(self.ctx, self.loop, idx)
+            for op, (args, kwargs) in self.broadcasts.items():
+                # Nobody awaits these, so retrieve any failure to keep asyncio from complaining about it
+                worker.submit(op, args, kwargs).add_done_callback(lambda future: future.exception())
+        return worker
+
+    def worker_for(self, channel_id: int) -> GameWorker:
+        return self.worker(hash(channel_id) % len(self.workers))
+
+    async def run(self, channel_id: int, op: str, *args, **kwargs):
+        return await self.worker_for(channel_id).submit(op, args, kwargs)
+
+    async def broadcast(self, op: str, *args, **kwargs):
+        self.broadcasts[op] = args, kwargs
+        await asyncio.gather(*(self.worker(idx).submit(op, args, kwargs) for idx in range(len(self.workers))))
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
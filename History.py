@@ -0,0 +1,176 @@
+# Game history recording for LoRiggio
+#
+# Every cup, raise, call and outcome gets appended to a queue, and a background thread writes them out
+# in batches as Parquet files, so the commands themselves only ever pay for the enqueue.
+# Needs pyarrow, which the bot otherwise doesn't: `pip install pyarrow`
+
+
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Optional
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+log = logging.getLogger("loriggio.history")
+
+# Columns of an event, in the order EventRecorder.record expects them. Unused columns are left null.
+EVENT_COLUMNS = [
+    ("ts", "timestamp"),  # When it happened, in seconds since the epoch
+    ("event", "string"),  # cup, raise, call, outcome or game_over
+    ("game_id", "string"),
+    ("channel_id", "int64"),
+    ("gamemode", "string"),
+    ("dice_sides", "int32"),
+    ("round", "int32"),
+    ("player_id", "int64"),  # Whose cup, who raised, who called, or who lost the round
+    ("dice_count", "int32"),  # The bet raised to or called
+    ("dice_num", "int32"),
+    ("dice", "list"),  # Every die in the cup, lowest first
+    ("actual_count", "int32"),  # How many dice matched the called bet
+]
+
+
+def event_schema():
+    types = {"timestamp": pa.timestamp("ms", tz="UTC"), "string": pa.string(), "int64": pa.int64(),
+             "int32": pa.int32(), "list": pa.list_(pa.int32())}
+    return pa.schema([(name, types[kind]) for name, kind in EVENT_COLUMNS])
+
+
+_FLUSH = object()
+_STOP = object()
+
+MAX_WRITE_FAILURES = 3  # Failures in a row before recording gives up, rather than queueing events forever
+
+
+class EventRecorder:
+    """
+    Appends events to rotating Parquet files in `directory`, one row group per batch.
+    Files are named "<prefix>-<start time>-<pid>-<n>.parquet", so several processes can share a directory,
+    and carry a ".part" suffix until they're closed, so readers only ever see finished files.
+    A Parquet file is unreadable until its footer is written on close, so a crash loses the whole open file.
+    That's why files are kept short by default, trading lots of small files for at most a minute or two of events.
+    """
+
+    def __init__(self, directory: str, prefix: str = "events", batch_size: int = 10_000,
+                 flush_interval: float = 30.0, max_file_bytes: int = 64 * 1024 * 1024,
+                 max_file_age: float = 60.0):
+        if pa is None:
+            raise RuntimeError("Recording game history needs pyarrow. Install it with `pip install pyarrow`.")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_file_bytes = max_file_bytes
+        self.max_file_age = max_file_age
+        self.schema = event_schema()
+
+        self.queue = queue.SimpleQueue()
+        self.writer: Optional[pq.ParquetWriter] = None
+        self.path: Optional[str] = None
+        self.opened_at = 0.0
+        self.file_count = 0
+        self.failures = 0
+        self.failed = False
+
+        self.thread = threading.Thread(target=self.run, name="loriggio-history", daemon=True)
+        self.thread.start()
+
+    def record(self, *event):
+        """Queue an event, given as one value per EVENT_COLUMNS entry. Never blocks, and does nothing after giving up."""
+        if not self.failed:
+            self.queue.put(event)
+
+    def flush(self):
+        if not self.failed:
+            self.queue.put(_FLUSH)
+
+    def close(self):
+        """Write out everything queued so far and finish the current file."""
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+
+    # region Writer Thread
+
+    def run(self):
+        try:
+            self.write_events()
+        except Exception:
+            log.exception("History writer crashed, no longer recording game history")
+            self.failed = True
+
+    def write_events(self):
+        pending = []
+        last_write = time.monotonic()
+        while True:
+            try:
+                event = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                event = _FLUSH
+
+            forced = event is _FLUSH or event is _STOP
+            if not forced:
+                pending.append(event)
+            if pending and (forced or len(pending) >= self.batch_size
+                            or time.monotonic() - last_write >= self.flush_interval):
+                try:
+                    self.write_batch(pending)
+                    self.failures = 0
+                except Exception:
+                    log.exception(f"Failed to write {len(pending)} events, dropping them")
+                    self.add_failure()
+                pending = []
+                last_write = time.monotonic()
+            if event is _STOP or self.failed:
+                self.close_file()
+                return
+            if self.writer is not None and time.monotonic() - self.opened_at >= self.max_file_age:
+                self.close_file()
+
+    def write_batch(self, events: list[tuple]):
+        if self.writer is not None and os.path.getsize(self.path + ".part") >= self.max_file_bytes:
+            self.close_file()
+        if self.writer is None:
+            self.open_file()
+
+        columns = list(zip(*events))
+        columns[0] = [int(ts * 1000) for ts in columns[0]]
+        arrays = [pa.array(column, type=field.type) for column, field in zip(columns, self.schema)]
+        self.writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def open_file(self):
+        started = datetime.now().strftime("%Y%m%d-%H%M%S")
+        self.path = os.path.join(self.directory, f"{self.prefix}-{started}-{os.getpid()}-{self.file_count}.parquet")
+        self.file_count += 1
+        self.writer = pq.ParquetWriter(self.path + ".part", self.schema, compression="zstd")
+        self.opened_at = time.monotonic()
+
+    def close_file(self):
+        if self.writer is None:
+            return
+        try:
+            self.writer.close()
+            os.replace(self.path + ".part", self.path)
+        except Exception:
+            log.exception(f"Failed to finish {self.path}, its events may be lost")
+            self.add_failure()
+        finally:
+            self.writer = None
+            self.path = None
+
+    def add_failure(self):
+        self.failures += 1
+        if self.failures >= MAX_WRITE_FAILURES and not self.failed:
+            log.error(f"Writing game history failed {self.failures} times in a row, no longer recording it")
+            self.failed = True
+
+    # endregion
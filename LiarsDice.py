@@ -1,10 +1,20 @@
+import itertools
+import logging
 import random
+import time
+import uuid
+from dataclasses import dataclass, field
 from enum import Enum
+from typing import Callable, Optional
 
 import discord
 from discord import app_commands, Interaction, Client
+from discord.utils import MISSING
 
-from utils import whisper, shout
+from History import EventRecorder
+from utils import whisper, shout, bind_log_context, log_latency
+
+log = logging.getLogger("loriggio.liars")
 
 
 class ErrorResponse(RuntimeError):
@@ -24,9 +34,32 @@ class LiarsDiceGameMode(Enum):
 
 GAMEMODE_CONVERSION: dict[str, LiarsDiceGameMode] = {mode.name: mode for mode in LiarsDiceGameMode}
 
+
+@dataclass(frozen=True)
+class PlayerRef:
+    """
+    The parts of a discord.User the game needs. Unlike a User, it can be pickled and sent to a game worker.
+    Players are told apart by ID only, so a name change mid-game doesn't lose anyone.
+    """
+    id: int
+    mention: str = field(compare=False)
+    display_name: str = field(compare=False)
+
+    @staticmethod
+    def from_user(user: discord.User) -> "PlayerRef":
+        return PlayerRef(id=user.id, mention=user.mention, display_name=user.display_name)
+
+
+BET_RANK_SHIFT = 32  # Bits reserved for the lower half of a packed bet rank
+MAX_DICE_COUNT = (1 << BET_RANK_SHIFT) - 1
+
+SPARSE_CUP_RATIO = 4  # Cups switch to a face -> count map once there are this many times more sides than dice
+
+AUTOCOMPLETE_LIMIT = 25  # Most choices Discord will show for an autocompleted option
+
 # region Emoji Stuff
 
-my_emojis: dict[str, discord.Emoji] = {}
+my_emojis: dict[str, str] = {}  # Emoji name -> the markup that renders it
 
 die_colors = ["red"]
 
@@ -37,13 +70,13 @@ def load_emojis(client: discord.Client):
     for i in range(1, 7):
         for color in die_colors:
             emoji = discord.utils.get(client.emojis, name=f"d6_{color}_{i}")
-            my_emojis[emoji.name] = emoji
+            my_emojis[emoji.name] = str(emoji)
 
 
 def stringify_die(die: int) -> str:
-    if die <= 6:
+    if die <= 6 and my_emojis:
         # Use the d6 custom emojis
-        return str(my_emojis[f"d6_{random.choice(die_colors)}_{die}"])
+        return my_emojis[f"d6_{random.choice(die_colors)}_{die}"]
     else:
         return str(die)
 
@@ -61,29 +94,55 @@ def stringify_cup(cup: list[int]) -> str:
 class LiarsDicePlayerState:
     num_dice: int  # how many dice this player has left
     loss_count: int  # How many times this player has lost a round
-    cup: list[int]  # The cup belonging to this player. cup[X - 1] = # of Xs this player has
+    # The cup belonging to this player. Dense: cup[X - 1] = # of Xs this player has. Sparse: cup[X] = # of Xs
+    cup: list[int] | dict[int, int]
 
     def __init__(self, game):
         self.game = game  # Have to define it without strong typing because Python doesn't have good forward declaration
         self.num_dice = game.dice_per_player
         self.loss_count = 0
 
+    def is_cup_sparse(self) -> bool:
+        return isinstance(self.cup, dict)
+
     def cast_dice(self):
-        self.cup = [0 for i in range(self.game.dice_sides)]
-        for die in [random.randint(1, self.game.dice_sides) for _ in range(self.num_dice)]:
-            self.cup[die - 1] += 1
+        rolls = [random.randint(1, self.game.dice_sides) for _ in range(self.num_dice)]
+        if self.game.dice_sides > SPARSE_CUP_RATIO * self.num_dice:
+            # Most faces would be empty, so only keep the ones that were rolled
+            self.cup = {}
+            for die in rolls:
+                self.cup[die] = self.cup.get(die, 0) + 1
+        else:
+            self.cup = [0] * self.game.dice_sides
+            for die in rolls:
+                self.cup[die - 1] += 1
+
+    def count(self, dice_num: int) -> int:
+        if self.is_cup_sparse():
+            return self.cup.get(dice_num, 0)
+        return self.cup[dice_num - 1]
+
+    def dice(self) -> list[int]:
+        """Every die in the cup, lowest first."""
+        if self.is_cup_sparse():
+            faces = sorted(self.cup.items())
+        else:
+            faces = ((dice_num + 1, dice_count) for dice_num, dice_count in enumerate(self.cup) if dice_count)
+        return [dice_num for dice_num, dice_count in faces for _ in range(dice_count)]
 
 
 class LiarsDiceGame:
     # Game Info
-    creator: discord.User  # Discord ID of the creator?
-    all_players: set[discord.User]  # Set of all players present at the end of the game
-    live_players: list[discord.User]  # List of Discord Users of players still in the game, used to maintain turn order
+    game_id: str  # Unique per game, tells games apart in the recorded history
+    channel_id: int  # Channel the game is played in, if any
+    creator: PlayerRef  # The player who created the game
+    all_players: set[PlayerRef]  # Set of all players present at the end of the game
+    live_players: list[PlayerRef]  # List of players still in the game, used to maintain turn order
     player_states = dict[int, LiarsDicePlayerState]  # The state of each player in the game
     is_game_finished: bool  # Is the game over?
 
     # Matchmaking
-    queued_to_join: list[discord.User]  # list of players to join the game next round
+    queued_to_join: list[PlayerRef]  # list of players to join the game next round
 
     # Game Settings
     dice_per_player: int  # duh
@@ -97,8 +156,10 @@ class LiarsDiceGame:
     raiser_idx: int  # idx of the next player to raise the bet
     current_bet: tuple[int, int]  # The current bet. Format: [dice count, # on the dice], e.g. [2, 3] = 2 Threes
 
-    def __init__(self, creator: discord.User, dice_per_player=5, dice_sides=6,
-                 gamemode=LiarsDiceGameMode.FIRST_ELIMINATION, allow_count_reset_on_increment=False):
+    def __init__(self, creator: PlayerRef, dice_per_player=5, dice_sides=6,
+                 gamemode=LiarsDiceGameMode.FIRST_ELIMINATION, allow_count_reset_on_increment=False,
+                 channel_id: int = None):
+        self.channel_id = channel_id
         self.creator = creator
         self.dice_per_player = dice_per_player
         self.dice_sides = dice_sides
@@ -111,6 +172,7 @@ class LiarsDiceGame:
         self.join(creator)
 
     def reset(self):
+        self.game_id = uuid.uuid4().hex
         self.live_players = list(self.all_players)
         self.round_num = 0  # We count rounds starting at 1. Fight me.
         self.raiser_idx = 0
@@ -123,18 +185,26 @@ class LiarsDiceGame:
     def is_game_started(self) -> bool:
         return self.round_num > 0
 
-    def is_player_present(self, player: discord.User, allow_queued_players: bool = False):
+    def record(self, event: str, player: PlayerRef = None, dice_count: int = None, dice_num: int = None,
+               dice: list[int] = None, actual_count: int = None):
+        """Hand an event to the history recorder, if there is one. See History.EVENT_COLUMNS."""
+        if event_recorder is not None:
+            event_recorder.record(time.time(), event, self.game_id, self.channel_id, self.gamemode.name,
+                                  self.dice_sides, self.round_num, player.id if player else None,
+                                  dice_count, dice_num, dice, actual_count)
+
+    def is_player_present(self, player: PlayerRef, allow_queued_players: bool = False):
         return player in self.all_players or (allow_queued_players and player in self.queued_to_join)
 
-    def get_player(self, idx: int) -> discord.User:
+    def get_player(self, idx: int) -> PlayerRef:
         return self.live_players[idx % len(self.live_players)]
 
-    def join(self, player: discord.User):
+    def join(self, player: PlayerRef):
         if player in self.all_players or player in self.queued_to_join:
             raise ErrorResponse("You are already part of the game.")
         self.queued_to_join.append(player)
 
-    def leave(self, player: discord.User):
+    def leave(self, player: PlayerRef):
         if player in self.all_players:
             if self.in_round:
                 raise ErrorResponse("Cannot leave in the middle of the round.")
@@ -146,7 +216,7 @@ class LiarsDiceGame:
         else:
             raise ErrorResponse("You aren't part of the game.")
 
-    def start(self, player: discord.User):
+    def start(self, player: PlayerRef):
         if player != self.creator:
             raise ErrorResponse("Only the creator can start the game.")
         if self.round_num > 0:
@@ -162,6 +232,8 @@ class LiarsDiceGame:
         if self.in_round:
             raise ErrorResponse("We're in the middle of a round!")
 
+        if not self.is_game_finished:
+            self.record("game_over")
         self.is_game_finished = True
         embed = discord.Embed(title="Liar's Dice: Final Results",
                               description="The game is over! Here are everyone's final scores")
@@ -191,11 +263,13 @@ class LiarsDiceGame:
         # Cast the dice for players still in the game
         for player in self.live_players:
             self.player_states[player.id].cast_dice()
+            if event_recorder is not None:
+                self.record("cup", player, dice=self.player_states[player.id].dice())
 
         self.current_bet = 0, 0
         self.in_round = True
 
-    def raise_bet(self, player: discord.User, dice_count: int, dice_num: int):
+    def raise_bet(self, player: PlayerRef, dice_count: int, dice_num: int):
         # wrap around on raiser_idx is handled here
         if player != self.get_player(self.raiser_idx):
             raise ErrorResponse(f"It's not your turn to raise.")
@@ -206,25 +280,65 @@ class LiarsDiceGame:
         if dice_count < 1:
             raise ErrorResponse("Dice count must be positive.")
 
-        # Validate: Bet cannot be lowered (mostly)
+        if dice_count > MAX_DICE_COUNT:
+            raise ErrorResponse("That's way too many dice.")
+
+        if not self.is_legal_raise(dice_count, dice_num):
+            raise ErrorResponse(self.explain_illegal_raise(dice_count, dice_num))
+
+        self.current_bet = dice_count, dice_num
+        self.raiser_idx += 1
+        self.record("raise", player, dice_count, dice_num)
+
+    def bet_rank(self, dice_count: int, dice_num: int) -> int:
+        """
+        Packs a bet into one integer, ordered so that every legal raise outranks the bet it raises.
+        With count resets, bets are ordered by number then count, which matches the rules exactly.
+        Without them, bets are ordered by count then number, and a higher rank alone isn't enough (see is_legal_raise).
+        """
+        if self.allow_count_reset_on_increment:
+            return (dice_num << BET_RANK_SHIFT) | dice_count
+        return (dice_count << BET_RANK_SHIFT) | dice_num
+
+    def is_legal_raise(self, dice_count: int, dice_num: int) -> bool:
+        if self.bet_rank(dice_count, dice_num) <= self.bet_rank(*self.current_bet):
+            return False
+        # Without count resets, raising the count still can't lower the number
+        return self.allow_count_reset_on_increment or dice_num >= self.current_bet[1]
+
+    def explain_illegal_raise(self, dice_count: int, dice_num: int) -> str:
         if dice_num < self.current_bet[1]:
-            raise ErrorResponse("Cannot lower the dice number.")
+            return "Cannot lower the dice number."
         if dice_count < self.current_bet[0]:
             if self.allow_count_reset_on_increment:
-                # Dice count can be lowered if dice number increases
-                if dice_num <= self.current_bet[1]:
-                    raise ErrorResponse("Cannot lower the dice count without raising the dice number.")
-            else:
-                raise ErrorResponse("Cannot lower the dice count.")
+                return "Cannot lower the dice count without raising the dice number."
+            return "Cannot lower the dice count."
+        return "Bet must be raised."
 
-        # Validate: Part of the bet has to be raised
-        if dice_count == self.current_bet[0] and dice_num == self.current_bet[1]:
-            raise ErrorResponse("Bet must be raised.")
+    def total_dice(self) -> int:
+        return sum(self.player_states[p.id].num_dice for p in self.live_players)
 
-        self.current_bet = dice_count, dice_num
-        self.raiser_idx += 1
+    def legal_raises(self, limit: int, dice_count: int = None, dice_num: int = None) -> list[tuple[int, int]]:
+        """
+        The next `limit` legal raises in rank order, optionally pinned to a dice count or number.
+        Bets on more dice than there are on the table are legal, but never worth suggesting, so they're left out.
+        """
+        bet_count, bet_num = self.current_bet
+        counts = range(dice_count, dice_count + 1) if dice_count is not None else range(1, self.total_dice() + 1)
+        nums = range(dice_num, dice_num + 1) if dice_num is not None else range(1, self.dice_sides + 1)
+        # Skip straight past everything that can't be legal instead of checking it
+        counts = range(max(counts.start, 1), counts.stop)
+        nums = range(max(nums.start, bet_num, 1), min(nums.stop, self.dice_sides + 1))
+        if self.allow_count_reset_on_increment:
+            bets = ((count, num) for num in nums
+                    for count in range(max(counts.start, bet_count + 1) if num == bet_num else counts.start,
+                                       counts.stop))
+        else:
+            bets = ((count, num) for count in range(max(counts.start, bet_count), counts.stop)
+                    for num in nums if (count, num) != self.current_bet)
+        return list(itertools.islice(bets, limit))
 
-    def call_bet(self, player: discord.User) -> discord.Embed:
+    def call_bet(self, player: PlayerRef) -> discord.Embed:
         """
         Returns a message containing the details of the call.
         Remember that the bet is if there are AT LEAST X of Y dice on the table.
@@ -239,12 +353,13 @@ class LiarsDiceGame:
         final_hands_messages = []
         count = 0
         for p in self.live_players:
-            p_count = self.player_states[p.id].cup[self.current_bet[1] - 1]
+            p_count = self.player_states[p.id].count(self.current_bet[1])
             final_hands_messages.append(f"- {p.mention}: {stringify_cup(self.peek(p))}\n")
             count_messages.append(f"- {p.mention} has {p_count} {stringify_die(self.current_bet[1])}s\n")
             count += p_count
         # Compare it to the bet
         bet_was_met = count >= self.current_bet[0]
+        self.record("call", player, *self.current_bet, actual_count=count)
 
         last_raiser = self.get_player(self.raiser_idx - 1)
 
@@ -266,10 +381,13 @@ class LiarsDiceGame:
         player_who_lost = player if bet_was_met else last_raiser
         self.on_player_lose(player_who_lost)
         self.in_round = False
+        self.record("outcome", player_who_lost)
+        if self.is_game_finished:
+            self.record("game_over")
 
         return embed
 
-    def on_player_lose(self, player: discord.User):
+    def on_player_lose(self, player: PlayerRef):
         if self.gamemode == LiarsDiceGameMode.SUDDEN_DEATH:
             # Kick the player who lost
             self.live_players.remove(player)
@@ -295,14 +413,10 @@ class LiarsDiceGame:
         elif self.gamemode == LiarsDiceGameMode.INFINITE:
             ps.loss_count += 1
 
-    def peek(self, player: discord.User) -> list[int]:
+    def peek(self, player: PlayerRef) -> list[int]:
         if self.round_num < 1:
             raise ErrorResponse("No dice have been thrown yet.")
-        dice = []
-        for dice_num, dice_count in enumerate(self.player_states[player.id].cup):
-            for _ in range(dice_count):
-                dice.append(dice_num + 1)
-        return dice
+        return self.player_states[player.id].dice()
 
     def add_state_embed(self, embed: discord.Embed):
         embed.add_field(name="Mode:", value=str(self.gamemode), inline=False)
@@ -325,108 +439,127 @@ class LiarsDiceGame:
             players_msg = ''.join([f"- {player.mention}\n" for player in self.all_players])
             embed.add_field(name="Players:", value=players_msg)
 
-    def create_view(self):  # Can't do return declaration because Python lacks good forward declaration
-        return LiarsDiceView(self)
+    def view_layout(self, show_settings: bool = False) -> tuple:
+        """Which layout to pass to get_view for a message about this game."""
+        if not self.is_game_started():
+            return "start", self.gamemode if show_settings else None
+        return "gameplay", self.current_bet != (0, 0)
 
 
 # region UI Components
 
-class LiarsDiceView(discord.ui.View):
-    game: LiarsDiceGame  # The game this view belongs to
-
-    def __init__(self, game: LiarsDiceGame):
-        super().__init__()
-        self.game = game
-        self.on_error = lambda interaction, err, item: on_error(interaction, err)
-
-    def add_gameplay_bar(self):
-        if self.game.is_game_started():
-            peek_btn = discord.ui.Button(label="Peek")
-            peek_btn.callback = peek.callback
-            self.add_item(peek_btn)
-
-            if self.game.current_bet != (0, 0):
-                call_btn = discord.ui.Button(label="Call", style=discord.ButtonStyle.primary)
-                call_btn.callback = call_bet.callback
-                self.add_item(call_btn)
-
-        else:
-            self.add_start_bar()
-        return self
-
-    def add_start_bar(self):
-        join_btn = discord.ui.Button(label="Join Game")
-        join_btn.callback = join.callback
-        leave_btn = discord.ui.Button(label="Leave Game")
-        leave_btn.callback = leave.callback
-        start_btn = discord.ui.Button(label="Start!", style=discord.ButtonStyle.primary)
-        start_btn.callback = start.callback
-
-        self.add_item(join_btn)
-        self.add_item(leave_btn)
-        self.add_item(start_btn)
+# Every component routes by its custom_id alone. The channel comes from the interaction itself,
+# so one persistent view registered at startup can serve the buttons on every message in every channel.
+CUSTOM_ID_PREFIX = "liars:"
 
-        return self
-
-    def add_continue_bar(self):
-        continue_btn = discord.ui.Button(label="Continue", style=discord.ButtonStyle.primary)
-        continue_btn.callback = next_round.callback
-        self.add_item(continue_btn)
 
-        if self.game.gamemode == LiarsDiceGameMode.INFINITE:
-            end_btn = discord.ui.Button(label="End Game")
-            end_btn.callback = end.callback
-            self.add_item(end_btn)
+class LiarsDiceButton(discord.ui.Button):
+    action: str  # Name of the command this button runs
 
-        return self
+    def __init__(self, action: str, label: str, style: discord.ButtonStyle = discord.ButtonStyle.secondary):
+        super().__init__(label=label, style=style, custom_id=f"{CUSTOM_ID_PREFIX}{action}")
+        self.action = action
 
-    def add_end_bar(self):
-        reset_btn = discord.ui.Button(label="Play again", style=discord.ButtonStyle.primary)
-        reset_btn.callback = reset.callback
-
-        self.add_item(reset_btn)
-
-        return self
-
-    def add_mode_dropdown(self):
-        self.add_item(ModeDropdown(self.game, row=0))
-        return self
+    async def callback(self, interaction: Interaction[Client]):
+        await BUTTON_COMMANDS[self.action].callback(interaction)
+        log_latency(interaction)
 
 
 class ModeDropdown(discord.ui.Select):
-    game: LiarsDiceGame  # The game this dropdown belongs to
-
-    def __init__(self, game: LiarsDiceGame, row: int = None):
-        super().__init__(row=row, options=[
+    def __init__(self, gamemode: LiarsDiceGameMode = None, row: int = None):
+        super().__init__(row=row, custom_id=f"{CUSTOM_ID_PREFIX}mode", options=[
             discord.SelectOption(emoji=f"🎲", label=f"First Elimination",
                                  description="Standard dice elimination, ends after first player is out.",
                                  value=LiarsDiceGameMode.FIRST_ELIMINATION.name,
-                                 default=game.gamemode == LiarsDiceGameMode.FIRST_ELIMINATION),
+                                 default=gamemode == LiarsDiceGameMode.FIRST_ELIMINATION),
             discord.SelectOption(emoji=f"🥾", label=f"Last Man Standing",
                                  description="Standard dice elimination, ends when one player remains.",
                                  value=LiarsDiceGameMode.LAST_MAN_STANDING.name,
-                                 default=game.gamemode == LiarsDiceGameMode.LAST_MAN_STANDING),
+                                 default=gamemode == LiarsDiceGameMode.LAST_MAN_STANDING),
             discord.SelectOption(emoji=f"☠️", label=f"Sudden Death",
                                  description="When a player loses, they are kicked from the table.",
                                  value=LiarsDiceGameMode.SUDDEN_DEATH.name,
-                                 default=game.gamemode == LiarsDiceGameMode.SUDDEN_DEATH),
+                                 default=gamemode == LiarsDiceGameMode.SUDDEN_DEATH),
             discord.SelectOption(emoji=f"🔄", label=f"Infinite Mode",
                                  description="Game continues indefinitely.",
                                  value=LiarsDiceGameMode.INFINITE.name,
-                                 default=game.gamemode == LiarsDiceGameMode.INFINITE)
+                                 default=gamemode == LiarsDiceGameMode.INFINITE)
         ])
-        self.game = game
+
+    async def callback(self, interaction: Interaction[Client]):
+        await run_game_op(interaction, "set_mode", gamemode=GAMEMODE_CONVERSION[self.values[0]])
+        await interaction.response.defer()
+        log_latency(interaction)
+
+
+class LiarsDiceView(discord.ui.View):
+    def __init__(self):
+        super().__init__(timeout=None)
+        self.on_error = lambda interaction, err, item: on_error(interaction, err)
 
     async def interaction_check(self, interaction: Interaction[Client], /) -> bool:
-        if interaction.user != self.game.creator:
-            await whisper(interaction, "Only the game creator can change the settings.")
-            return False
+        bind_log_context(interaction, interaction.data.get("custom_id"))
         return True
 
-    async def callback(self, interaction: Interaction[Client]):
-        await interaction.response.defer()
-        assert interaction.data is not None and "custom_id" in interaction.data, "Invalid interaction data"
-        self.game.gamemode = GAMEMODE_CONVERSION[self.values[0]]
+    def add_gameplay_bar(self, can_call: bool):
+        self.add_item(LiarsDiceButton("peek", "Peek"))
+        if can_call:
+            self.add_item(LiarsDiceButton("call", "Call", style=discord.ButtonStyle.primary))
+        return self
+
+    def add_start_bar(self):
+        self.add_item(LiarsDiceButton("join", "Join Game"))
+        self.add_item(LiarsDiceButton("leave", "Leave Game"))
+        self.add_item(LiarsDiceButton("start", "Start!", style=discord.ButtonStyle.primary))
+        return self
+
+    def add_continue_bar(self, can_end: bool):
+        self.add_item(LiarsDiceButton("continue", "Continue", style=discord.ButtonStyle.primary))
+        if can_end:
+            self.add_item(LiarsDiceButton("end", "End Game"))
+        return self
+
+    def add_end_bar(self):
+        self.add_item(LiarsDiceButton("reset", "Play again", style=discord.ButtonStyle.primary))
+        return self
+
+    def add_mode_dropdown(self, gamemode: LiarsDiceGameMode = None):
+        self.add_item(ModeDropdown(gamemode, row=0))
+        return self
+
+
+# Message layouts, built once per distinct layout and reused for every message that shows them.
+# They're stopped right away, so sending them only attaches components: discord.py doesn't store finished views,
+# and clicks fall through to the persistent view registered in register_views instead.
+_layout_views: dict[tuple, LiarsDiceView] = {}
+
+
+def get_view(layout: str, option=None) -> LiarsDiceView:
+    key = layout, option
+    if key not in _layout_views:
+        view = LiarsDiceView()
+        if layout == "start":
+            if option is not None:
+                view.add_mode_dropdown(option)
+            view.add_start_bar()
+        elif layout == "gameplay":
+            view.add_gameplay_bar(can_call=option)
+        elif layout == "continue":
+            view.add_continue_bar(can_end=option)
+        elif layout == "end":
+            view.add_end_bar()
+        else:
+            raise ValueError(f"Unknown view layout '{layout}'")
+        view.stop()
+        _layout_views[key] = view
+    return _layout_views[key]
+
+
+def register_views(client: discord.Client):
+    """Register the one view that handles every Liar's Dice component. Call once the client is set up."""
+    router = (LiarsDiceView().add_mode_dropdown().add_start_bar()
+              .add_gameplay_bar(can_call=True).add_continue_bar(can_end=True).add_end_bar())
+    client.add_view(router)
 
 
 # endregion
@@ -434,54 +567,286 @@ class ModeDropdown(discord.ui.Select):
 
 # Liar's Dice Game State
 ld_games: dict[int, LiarsDiceGame] = {}  # Map channel IDs to individual games
+event_recorder: Optional[EventRecorder] = None  # Where game history goes, if it's being recorded
 
 
-# region Helper Functions
+# region Game Operations
+
+# Everything that reads or changes a game goes through one of these operations.
+# They're plain functions of picklable arguments, so they can run either right here on the event loop
+# or in a game worker process that owns this channel's game (see GameWorkers.py).
 
-async def new_game(ctx: discord.Interaction, force: bool = False):
-    global ld_games
-    if ctx.channel_id in ld_games and not ld_games[ctx.channel_id].is_game_finished:
-        if not (ctx.user == ld_games[ctx.channel_id].creator or ctx.user.guild_permissions.administrator):
+@dataclass(frozen=True)
+class GameRequest:
+    channel_id: int
+    channel_mention: str
+    player: PlayerRef
+    is_admin: bool  # Whether the player is a server admin
+
+
+@dataclass
+class GameReply:
+    content: Optional[str] = None
+    embed: Optional[discord.Embed] = None
+    view: Optional[tuple] = None  # Arguments for get_view
+    private: bool = False  # Whisper instead of shout
+    delete_after: Optional[float] = None
+
+
+GAME_OPS: dict[str, Callable] = {}
+
+
+def game_op(func):
+    GAME_OPS[func.__name__] = func
+    return func
+
+
+def get_game(req: GameRequest, ignore_user=False, allow_queued_players=False) -> LiarsDiceGame:
+    if req.channel_id not in ld_games:
+        raise ErrorResponse("There is no game in this channel. Run `/liars new` to make one!")
+    game = ld_games[req.channel_id]
+    if not ignore_user and not game.is_player_present(req.player, allow_queued_players=allow_queued_players):
+        raise ErrorResponse(f"You are not a part of the {req.channel_mention} Liar's Dice game. "
+                            f"Run `/liars join` to join the fun!")
+    return game
+
+
+@game_op
+def set_emojis(emojis: dict[str, str]):
+    my_emojis.update(emojis)
+
+
+@game_op
+def start_history(directory: str):
+    global event_recorder
+    if event_recorder is None:
+        event_recorder = EventRecorder(directory)
+
+
+@game_op
+def stop_history():
+    global event_recorder
+    if event_recorder is not None:
+        event_recorder.close()
+        event_recorder = None
+
+
+@game_op
+def new_game(req: GameRequest, force: bool = False) -> list[GameReply]:
+    if req.channel_id in ld_games and not ld_games[req.channel_id].is_game_finished:
+        if not (req.player == ld_games[req.channel_id].creator or req.is_admin):
             raise ErrorResponse("Only the creator of the game or a server admin can restart it.")
         if not force:
             raise ErrorResponse("A game is already running. Run `/liars force_new` to force a new game.")
 
-    ld_games[ctx.channel_id] = LiarsDiceGame(ctx.user)
-    game = ld_games[ctx.channel_id]
+    ld_games[req.channel_id] = LiarsDiceGame(req.player, channel_id=req.channel_id)
+    game = ld_games[req.channel_id]
 
-    await shout(ctx, f"Game was created for {ctx.channel.mention}! "
-                     f"Use the buttons below to join, leave, or start!",
-                view=LiarsDiceView(game).add_mode_dropdown().add_start_bar())
+    return [GameReply(f"Game was created for {req.channel_mention}! "
+                      f"Use the buttons below to join, leave, or start!",
+                      view=game.view_layout(show_settings=True))]
 
 
-async def reset_game(ctx: discord.Interaction, force: bool = False):
-    global ld_games
-    if ctx.channel_id not in ld_games:
+@game_op
+def reset_game(req: GameRequest, force: bool = False) -> list[GameReply]:
+    if req.channel_id not in ld_games:
         raise ErrorResponse("No previous game has been played")
 
-    if not ld_games[ctx.channel_id].is_game_finished:
-        if not (ctx.user == ld_games[ctx.channel_id].creator or ctx.user.guild_permissions.administrator):
+    if not ld_games[req.channel_id].is_game_finished:
+        if not (req.player == ld_games[req.channel_id].creator or req.is_admin):
             raise ErrorResponse("Only the creator of the game or a server admin can restart it.")
         if not force:
             raise ErrorResponse("A game is already running. Run `/liars force_reset` to force a new game.")
 
-    game = ld_games[ctx.channel_id]
-    game.creator = ctx.user  # Re-assign the creator (allows admins to steal back the game)
+    game = ld_games[req.channel_id]
+    game.creator = req.player  # Re-assign the creator (allows admins to steal back the game)
     game.reset()
 
-    await shout(ctx, f"Game was reset for {ctx.channel.mention} with all the old players! "
-                     f"Use the buttons below to start the game!",
-                view=LiarsDiceView(game).add_mode_dropdown().add_start_bar())
+    return [GameReply(f"Game was reset for {req.channel_mention} with all the old players! "
+                      f"Use the buttons below to start the game!",
+                      view=game.view_layout(show_settings=True))]
 
 
-async def validate_cmd_presence(ctx: discord.Interaction, ignore_user=False, allow_queued_players=False):
-    global ld_games
-    if ctx.channel_id not in ld_games:
-        raise ErrorResponse("There is no game in this channel. Run `/liars new` to make one!")
-    if (not ignore_user and
-            not ld_games[ctx.channel_id].is_player_present(ctx.user, allow_queued_players=allow_queued_players)):
-        raise ErrorResponse(f"You are not a part of the {ctx.channel.mention} Liar's Dice game. "
-                            f"Run `/liars join` to join the fun!")
+@game_op
+def set_mode(req: GameRequest, gamemode: LiarsDiceGameMode) -> list[GameReply]:
+    game = get_game(req, ignore_user=True)
+    if req.player != game.creator:
+        raise ErrorResponse("Only the game creator can change the settings.")
+    game.gamemode = gamemode
+    return []
+
+
+@game_op
+def join_game(req: GameRequest) -> list[GameReply]:
+    get_game(req, ignore_user=True).join(req.player)
+    return [GameReply(f"{req.player.mention} has joined the game!")]
+
+
+@game_op
+def leave_game(req: GameRequest) -> list[GameReply]:
+    get_game(req, allow_queued_players=True).leave(req.player)
+    return [GameReply(f"{req.player.mention} has left the game.")]
+
+
+@game_op
+def start_game(req: GameRequest) -> list[GameReply]:
+    game = get_game(req, allow_queued_players=True)
+
+    game.start(req.player)
+
+    embed = discord.Embed(title="Liar's Dice",
+                          description=f"The die is cast, the round begun! "
+                                      f"{game.get_player(game.raiser_idx).mention}, you set the bet!\n"
+                                      f"Use '/liars raise'.")
+    game.add_state_embed(embed)
+
+    return [GameReply(embed=embed, view=game.view_layout())]
+
+
+@game_op
+def game_info(req: GameRequest) -> list[GameReply]:
+    game = get_game(req, ignore_user=True)
+
+    embed = discord.Embed(title="Liar's Dice", description="")
+    game.add_state_embed(embed)
+
+    return [GameReply(embed=embed, view=game.view_layout(), private=True, delete_after=15)]
+
+
+@game_op
+def next_round_game(req: GameRequest) -> list[GameReply]:
+    game = get_game(req)
+
+    if game.round_num == 0:
+        raise ErrorResponse("Game has not yet begun. Have the game creator call `/liars start`.")
+
+    game.begin_next_round()
+
+    embed = discord.Embed(title="Liar's Dice",
+                          description="The die is cast, the round begun! "
+                                      f"{game.get_player(game.raiser_idx).mention}, you set the bet.")
+    game.add_state_embed(embed)
+
+    return [GameReply(embed=embed, view=game.view_layout())]
+
+
+@game_op
+def peek_cup(req: GameRequest) -> list[GameReply]:
+    dice = get_game(req).peek(req.player)
+    return [GameReply(stringify_cup(dice), private=True, delete_after=60)]
+
+
+@game_op
+def raise_game_bet(req: GameRequest, dice_count: int, dice_num: int) -> list[GameReply]:
+    game = get_game(req)
+
+    game.raise_bet(req.player, dice_count, dice_num)
+
+    return [GameReply(f"{req.player.mention} has raised the bet to {dice_count} {stringify_die(dice_num)}s. "
+                      f"Next to raise is {game.get_player(game.raiser_idx).mention}.",
+                      view=game.view_layout())]
+
+
+@game_op
+def raise_choices(req: GameRequest, option: str, current: str, dice_count: Optional[int] = None,
+                  dice_num: Optional[int] = None) -> list[int]:
+    """Values to suggest for `option` that make a legal raise, given whatever the other option is set to."""
+    game = ld_games.get(req.channel_id)
+    if game is None or not game.in_round:
+        return []
+    # The other option is whatever the player has typed so far, so anything out of range just counts as unset
+    if dice_count is not None and not 1 <= dice_count <= MAX_DICE_COUNT:
+        dice_count = None
+    if dice_num is not None and not 1 <= dice_num <= game.dice_sides:
+        dice_num = None
+    if option == "dice_count":
+        candidates = ((count, dict(dice_count=count, dice_num=dice_num)) for count in range(1, game.total_dice() + 1))
+    else:
+        candidates = ((num, dict(dice_count=dice_count, dice_num=num))
+                      for num in range(max(game.current_bet[1], 1), game.dice_sides + 1))
+    choices = []
+    for value, bet in candidates:
+        if str(value).startswith(current) and game.legal_raises(1, **bet):
+            choices.append(value)
+            if len(choices) >= AUTOCOMPLETE_LIMIT:
+                break
+    return choices
+
+
+@game_op
+def call_game_bet(req: GameRequest) -> list[GameReply]:
+    game = get_game(req)
+
+    result = game.call_bet(req.player)
+    continue_view = "continue", game.gamemode == LiarsDiceGameMode.INFINITE
+    replies = [GameReply(embed=result)]
+    if game.gamemode == LiarsDiceGameMode.INFINITE:
+        replies.append(GameReply(f"Use the buttons below to continue to the next round or end the game.",
+                                 view=continue_view))
+    else:
+        if not game.is_game_finished:
+            replies.append(GameReply(f"Press the button below to move on to the next round.", view=continue_view))
+        else:
+            replies.append(GameReply(f"And the game is over! "
+                                     f"{game.get_player(0).mention}, congratulations! You're the winner!\n"
+                                     f"To prepare a new game with the same people, press the button below.",
+                                     view=("end",)))
+    return replies
+
+
+@game_op
+def end_game(req: GameRequest) -> list[GameReply]:
+    game = get_game(req)
+
+    if not (req.player == game.creator or req.is_admin):
+        raise ErrorResponse("Only the game creator or an admin can end the game.")
+
+    result = game.end_game()
+    return [GameReply(embed=result),
+            GameReply(f"To prepare a new game with the same people, press the button below.", view=("end",))]
+
+
+class LocalGameExecutor:
+    """Runs game operations inline, on the event loop. The default."""
+
+    async def run(self, channel_id: int, op: str, *args, **kwargs):
+        return GAME_OPS[op](*args, **kwargs)
+
+    async def broadcast(self, op: str, *args, **kwargs):
+        GAME_OPS[op](*args, **kwargs)
+
+    def close(self):
+        stop_history()
+
+
+game_executor = LocalGameExecutor()  # Swapped out for a GameWorkers.ProcessGameExecutor to run games off the loop
+
+# endregion
+
+
+# region Helper Functions
+
+def option_int(value) -> Optional[int]:
+    """An integer option as typed so far during autocomplete. Discord doesn't promise it's an int yet."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def make_request(ctx: discord.Interaction) -> GameRequest:
+    return GameRequest(channel_id=ctx.channel_id, channel_mention=ctx.channel.mention,
+                       player=PlayerRef.from_user(ctx.user),
+                       is_admin=ctx.user.guild_permissions.administrator)
+
+
+async def run_game_op(ctx: discord.Interaction, op: str, **kwargs):
+    """Run a game operation for the interaction's channel, then send whatever it replied with."""
+    replies = await game_executor.run(ctx.channel_id, op, make_request(ctx), **kwargs)
+    for reply in replies:
+        send = whisper if reply.private else shout
+        await send(ctx, reply.content, embed=reply.embed or MISSING,
+                   view=get_view(*reply.view) if reply.view else MISSING, delete_after=reply.delete_after)
 
 
 # endregion
@@ -509,23 +874,25 @@ async def on_error(ctx: discord.Interaction[discord.Client], err: app_commands.A
     if isinstance(err, app_commands.errors.CommandInvokeError):
         err = err.original
 
-    if isinstance(err, discord.app_commands.CheckFailure):
-        return
+    try:
+        if isinstance(err, discord.app_commands.CheckFailure):
+            return
 
-    if isinstance(err, ErrorResponse):
-        await whisper(ctx, str(err))
-    else:
-        message = (f"\nException: {err.__class__.__name__}, "
-                   f"Command: {ctx.command.qualified_name if ctx.command else None}, User: {ctx.user}\n"
-                   f"Description: {err}\n")
-        await whisper(ctx, message, delete_after=None)
+        if isinstance(err, ErrorResponse):
+            await whisper(ctx, str(err))
+        else:
+            log.error("Unhandled error", exc_info=err)
+            message = (f"\nException: {err.__class__.__name__}, "
+                       f"Command: {ctx.command.qualified_name if ctx.command else None}, User: {ctx.user}\n"
+                       f"Description: {err}\n")
+            await whisper(ctx, message, delete_after=None)
+    finally:
+        # Successful commands log theirs on completion, and buttons in their callbacks
+        log_latency(ctx, failed=True)
 
 
 @ld_group.command(name="help", description="Pulls up the manual!")
 async def help_cmd(ctx: discord.Interaction):
-    global ld_games
-    global my_emojis
-
     embed = discord.Embed(title="Liar's Dice Bot Manual",
                           description=f"Here are some helpful commands for interacting with the bot! {stringify_die(5)}")
     cmd_descriptions = ''.join([f"- */liars {cmd.name}*: {cmd.description}\n" for cmd in ld_group.walk_commands()])
@@ -536,149 +903,95 @@ async def help_cmd(ctx: discord.Interaction):
 
 @ld_group.command(description="Start a new game! Note you can have one distinct game per text channel.")
 async def new(ctx: discord.Interaction):
-    await new_game(ctx)
+    await run_game_op(ctx, "new_game")
 
 
 @ld_group.command(description="Force a new game to be created, even if one already exists.")
 async def force_new(ctx: discord.Interaction):
-    await new_game(ctx, force=True)
+    await run_game_op(ctx, "new_game", force=True)
 
 
 @ld_group.command(description="Reset the game with the same players.")
 async def reset(ctx: discord.Interaction):
-    await reset_game(ctx)
+    await run_game_op(ctx, "reset_game")
 
 
 @ld_group.command(description="Force a game to reset, even if the game is already exists.")
 async def force_reset(ctx: discord.Interaction):
-    await reset_game(ctx, force=True)
+    await run_game_op(ctx, "reset_game", force=True)
 
 
 @ld_group.command(description="Join the game for the channel you called the command in, if it exists.")
 async def join(ctx: discord.Interaction):
-    global ld_games
-    await validate_cmd_presence(ctx, ignore_user=True)
-
-    ld_games[ctx.channel_id].join(ctx.user)
-    await shout(ctx, f"{ctx.user.mention} has joined the game!")
+    await run_game_op(ctx, "join_game")
 
 
 @ld_group.command(description="Leave the game for the channel you called the command in.")
 async def leave(ctx: discord.Interaction):
-    global ld_games
-    await validate_cmd_presence(ctx, allow_queued_players=True)
-
-    ld_games[ctx.channel_id].leave(ctx.user)
-    await shout(ctx, f"{ctx.user.mention} has left the game.")
+    await run_game_op(ctx, "leave_game")
 
 
 @ld_group.command(description="Start the game for the channel you called the command in.")
 async def start(ctx: discord.Interaction):
-    global ld_games
-    await validate_cmd_presence(ctx, allow_queued_players=True)
-    game = ld_games[ctx.channel_id]
-
-    game.start(ctx.user)
-
-    embed = discord.Embed(title="Liar's Dice",
-                          description=f"The die is cast, the round begun! "
-                                      f"{game.get_player(game.raiser_idx).mention}, you set the bet!\n"
-                                      f"Use '/liars raise'.")
-    game.add_state_embed(embed)
-
-    await shout(ctx, embed=embed, view=LiarsDiceView(game).add_gameplay_bar())
+    await run_game_op(ctx, "start_game")
 
 
 @ld_group.command(description="Get information about the state of the game.")
 async def info(ctx: discord.Interaction):
-    global ld_games
-    await validate_cmd_presence(ctx, ignore_user=True)
-    game = ld_games[ctx.channel_id]
-
-    embed = discord.Embed(title="Liar's Dice", description="")
-    game.add_state_embed(embed)
-
-    await whisper(ctx, embed=embed, view=LiarsDiceView(game).add_gameplay_bar())
+    await run_game_op(ctx, "game_info")
 
 
 @ld_group.command(name="continue", description="Begin the next round of the game.")
 async def next_round(ctx: discord.Interaction):
-    global ld_games
-    await validate_cmd_presence(ctx)
-    game = ld_games[ctx.channel_id]
-
-    if game.round_num == 0:
-        raise ErrorResponse("Game has not yet begun. Have the game creator call `/liars start`.")
-
-    game.begin_next_round()
-
-    embed = discord.Embed(title="Liar's Dice",
-                          description="The die is cast, the round begun! "
-                                      f"{game.get_player(game.raiser_idx).mention}, you set the bet.")
-    game.add_state_embed(embed)
-
-    await shout(ctx, embed=embed, view=LiarsDiceView(game).add_gameplay_bar())
+    await run_game_op(ctx, "next_round_game")
 
 
 @ld_group.command(description="Take a look at your cup.")
 async def peek(ctx: discord.Interaction):
-    global ld_games
-    await validate_cmd_presence(ctx)
-    game = ld_games[ctx.channel_id]
-
-    dice = game.peek(ctx.user)
-    await whisper(ctx, stringify_cup(dice), delete_after=60)
+    await run_game_op(ctx, "peek_cup")
 
 
 @ld_group.command(name="raise", description="Raise the bet! "
                                             "First number is the number of dice, "
                                             "second number is the number on the dice.")
 async def raise_bet(ctx: discord.Interaction, dice_count: int, dice_num: int):
-    global ld_games
-    await validate_cmd_presence(ctx)
-    game = ld_games[ctx.channel_id]
+    await run_game_op(ctx, "raise_game_bet", dice_count=dice_count, dice_num=dice_num)
+
+
+@raise_bet.autocomplete("dice_count")
+async def raise_count_autocomplete(ctx: discord.Interaction, current: str) -> list[app_commands.Choice[int]]:
+    values = await game_executor.run(ctx.channel_id, "raise_choices", make_request(ctx), "dice_count", current,
+                                     dice_num=option_int(ctx.namespace.dice_num))
+    return [app_commands.Choice(name=str(value), value=value) for value in values]
 
-    game.raise_bet(ctx.user, dice_count, dice_num)
 
-    await shout(ctx, f"{ctx.user.mention} has raised the bet to {dice_count} {stringify_die(dice_num)}s. "
-                     f"Next to raise is {game.get_player(game.raiser_idx).mention}.",
-                view=LiarsDiceView(game).add_gameplay_bar())
+@raise_bet.autocomplete("dice_num")
+async def raise_num_autocomplete(ctx: discord.Interaction, current: str) -> list[app_commands.Choice[int]]:
+    values = await game_executor.run(ctx.channel_id, "raise_choices", make_request(ctx), "dice_num", current,
+                                     dice_count=option_int(ctx.namespace.dice_count))
+    return [app_commands.Choice(name=str(value), value=value) for value in values]
 
 
 @ld_group.command(name="call", description="12 fives... Call me a liar.")
 async def call_bet(ctx: discord.Interaction):
-    global ld_games
-    await validate_cmd_presence(ctx)
-    game = ld_games[ctx.channel_id]
-
-    result = game.call_bet(ctx.user)
-    view = LiarsDiceView(game)
-    await shout(ctx, embed=result)
-    if game.gamemode == LiarsDiceGameMode.INFINITE:
-        await shout(ctx, f"Use the buttons below to continue to the next round or end the game.",
-                    view=view.add_continue_bar())
-    else:
-        if not game.is_game_finished:
-            await shout(ctx, f"Press the button below to move on to the next round.", view=view.add_continue_bar())
-        else:
-            await shout(ctx, f"And the game is over! "
-                             f"{game.get_player(0).mention}, congratulations! You're the winner!\n"
-                             f"To prepare a new game with the same people, press the button below.",
-                        view=view.add_end_bar())
+    await run_game_op(ctx, "call_game_bet")
 
 
 @ld_group.command(description="Forcibly end the game.")
 async def end(ctx: discord.Interaction):
-    global ld_games
-    await validate_cmd_presence(ctx)
-    game = ld_games[ctx.channel_id]
+    await run_game_op(ctx, "end_game")
 
-    if not (ctx.user == game.creator or ctx.user.guild_permissions.administrator):
-        raise ErrorResponse("Only the game creator or an admin can end the game.")
+# endregion
 
-    result = game.end_game()
-    await shout(ctx, embed=result)
-    await shout(ctx, f"To prepare a new game with the same people, press the button below.",
-                view=LiarsDiceView(game).add_end_bar())
 
-# endregion
+# Commands reachable through LiarsDiceButton, by action
+BUTTON_COMMANDS: dict[str, app_commands.Command] = {
+    "peek": peek,
+    "call": call_bet,
+    "join": join,
+    "leave": leave,
+    "start": start,
+    "continue": next_round,
+    "end": end,
+    "reset": reset,
+}
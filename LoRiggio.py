@@ -1,18 +1,21 @@
 # LoRiggio bot by Pixelz22
 
 
+import asyncio
 import logging
 import json
+import signal
 import discord
 from discord import app_commands
 from discord.utils import get
 import os.path
 
-from utils import srcpath, whisper, shout
+from utils import srcpath, whisper, shout, setup_logging, bind_log_context, log_latency
 import LiarsDice
+import GameWorkers
 
+setup_logging(level=logging.DEBUG)  # Handlers run on a background thread, off the event loop
 logging.getLogger("discord").setLevel(logging.INFO)  # Silence Discord.py debug
-logging.basicConfig(level=logging.DEBUG)
 
 log = logging.getLogger("loriggio")
 
@@ -30,6 +33,12 @@ TOKEN = configuration["token"]
 # Numeric Discord ID of op (for testing purposes ONLY)
 OWNER = configuration["owner_id"] if "owner_id" in configuration else -1
 
+# Number of processes to run games in, 0 keeps them on the event loop
+GAME_WORKERS = configuration["game_workers"] if "game_workers" in configuration else 0
+
+# Directory to record game history to, None to not record it
+HISTORY_DIR = configuration["history_dir"] if "history_dir" in configuration else None
+
 
 # Setting up client
 intents = discord.Intents.default()
@@ -39,12 +48,40 @@ tree = app_commands.CommandTree(client)  # Build command tree
 
 loriggio = app_commands.Group(name="loriggio", description="testing?")
 
+
+async def tree_interaction_check(ctx: discord.Interaction) -> bool:
+    bind_log_context(ctx, ctx.command.qualified_name if ctx.command else None)
+    return True
+
+
+tree.interaction_check = tree_interaction_check
+
 # region Bot Events
 
+@client.event
+async def setup_hook():
+    LiarsDice.register_views(client)  # Persistent, so buttons keep working across restarts
+    try:
+        # client.run only handles Ctrl+C, so make SIGTERM shut down just as cleanly
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(client.close()))
+    except NotImplementedError:
+        pass  # Windows, which has no SIGTERM to speak of
+    if GAME_WORKERS > 0:
+        LiarsDice.game_executor = GameWorkers.ProcessGameExecutor(GAME_WORKERS)
+        log.info(f"Running games in {GAME_WORKERS} worker processes.")
+    if HISTORY_DIR is not None:
+        await LiarsDice.game_executor.broadcast("start_history", HISTORY_DIR)
+        log.info(f"Recording game history to {HISTORY_DIR}.")
+
 @client.event
 async def on_ready():
     print(f'{client.user} has connected to Discord!')
     LiarsDice.load_emojis(client)
+    await LiarsDice.game_executor.broadcast("set_emojis", LiarsDice.my_emojis)
+
+@client.event
+async def on_app_command_completion(ctx: discord.Interaction, command: app_commands.Command):
+    log_latency(ctx)
 
 @client.event
 async def on_message(msg: discord.Message):
@@ -97,5 +134,9 @@ async def ping(ctx: discord.Interaction, user: discord.User):
 # Register the slash commands
 tree.add_command(loriggio)
 tree.add_command(LiarsDice.ld_group)
-# Start the bot
-client.run(TOKEN)
+# Start the bot. Spawned game workers re-import this file, so only the main process may run it
+if __name__ == "__main__":
+    try:
+        client.run(TOKEN, log_handler=None)  # Logging is already set up, don't let discord.py add its own handler
+    finally:
+        LiarsDice.game_executor.close()  # Let the games finish writing their history
@@ -1,6 +1,13 @@
+import atexit
+import logging
+import logging.handlers
 import os
+import queue
+import threading
+import time
 import discord
 
+from contextvars import ContextVar
 from discord.utils import MISSING
 from typing import Optional
 
@@ -23,3 +30,101 @@ async def whisper(ctx: discord.Interaction, msg: Optional[str] = None, embed: di
     except discord.InteractionResponded:
         await ctx.followup.send(content=msg, embed=embed, view=view, ephemeral=True)
 
+
+# region Logging
+
+# Per-command fields attached to every record logged while handling an interaction
+log_context: ContextVar[dict] = ContextVar("log_context", default={})
+
+LOG_FORMAT = ("%(asctime)s %(levelname)s %(name)s "
+              "[guild=%(guild)s channel=%(channel)s command=%(command)s latency_ms=%(latency_ms)s] %(message)s")
+
+
+def bind_log_context(ctx: discord.Interaction, command: Optional[str]):
+    log_context.set({"guild": ctx.guild_id, "channel": ctx.channel_id, "command": command})
+
+
+def log_latency(ctx: discord.Interaction, failed: bool = False):
+    """Logs how long an interaction took to handle, to "loriggio.commands" for slash commands
+    and "loriggio.components" for buttons and dropdowns."""
+    logger = logging.getLogger("loriggio.commands" if ctx.command is not None else "loriggio.components")
+    latency = (discord.utils.utcnow() - ctx.created_at).total_seconds() * 1000
+    logger.info("Interaction failed" if failed else "Handled interaction", extra={"latency_ms": round(latency, 1)})
+
+
+class LogContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        fields = log_context.get()
+        for field in ("guild", "channel", "command"):
+            if not hasattr(record, field):
+                setattr(record, field, fields.get(field))
+        if not hasattr(record, "latency_ms"):
+            record.latency_ms = None
+        return True
+
+
+class DebugSamplingFilter(logging.Filter):
+    """Token bucket per logger: lets through at most `rate` DEBUG records a second, with bursts up to `burst`."""
+
+    def __init__(self, rate: float, burst: float):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets: dict[str, tuple[float, float]] = {}  # logger name -> (tokens, last refill time)
+        self.dropped: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(record.name, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[record.name] = tokens, now
+                self.dropped[record.name] = self.dropped.get(record.name, 0) + 1
+                return False
+            self.buckets[record.name] = tokens - 1, now
+            dropped = self.dropped.pop(record.name, 0)
+        if dropped:
+            record.msg = f"{record.msg} ({dropped} similar records dropped)"
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler runs the whole Formatter on the caller's thread before enqueuing.
+    # Only the message is merged here, so the args are snapshotted as they were when logged
+    # (they may be live objects the loop keeps changing), and the rest of the formatting is left to the listener.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(level: int = logging.DEBUG, debug_rate: float = 50.0, debug_burst: float = 200.0,
+                  handlers: Optional[list[logging.Handler]] = None):
+    """
+    Route the root logger through a queue, with the real handlers run by a background thread.
+    Debug records are sampled per logger before they're queued. The thread is stopped at exit, and only then.
+    """
+    if handlers is None:
+        handlers = [logging.StreamHandler()]
+    formatter = logging.Formatter(LOG_FORMAT)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(DebugSamplingFilter(debug_rate, debug_burst))
+    queue_handler.addFilter(LogContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # Flush whatever is left in the queue on shutdown
+
+# endregion